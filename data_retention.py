@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+İzer Webhook System veri saklama (retention) ve arşivleme işi
+Belirli bir yaştan eski mesajları sıkıştırılmış NDJSON arşivlerine taşır
+ve sıcak tablolardan küçük parçalar halinde siler.
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import mysql.connector
+from mysql.connector import Error
+from dotenv import load_dotenv
+
+# .env dosyasını yükle
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'port': int(os.getenv('DB_PORT', 3306)),
+    'user': os.getenv('DB_USER', 'root'),
+    'password': os.getenv('DB_PASSWORD', ''),
+    'database': os.getenv('DB_NAME', 'izer_webhook_system'),
+    'charset': 'utf8mb4',
+    'collation': 'utf8mb4_unicode_ci'
+}
+
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 90))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 200))
+RETENTION_SLEEP_SECONDS = float(os.getenv('RETENTION_SLEEP_SECONDS', 0.5))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+
+ARCHIVE_PREFIX = 'webhook_archive_'
+RETENTION_LOCK_NAME = 'izer_webhook_retention'
+
+# Alt tablolar ve arşiv kaydındaki anahtarları. agent_routing de arşivlenir, çünkü şemadaki
+# ON DELETE CASCADE ana satır silinince bu satırları arşivlenmeden silerdi.
+CHILD_TABLES = (
+    ('message_history', 'history'),
+    ('analytics_results', 'analytics'),
+    ('agent_routing', 'routing')
+)
+
+
+def _json_default(value: Any) -> Any:
+    """MySQL'den gelen JSON'a çevrilemeyen değerleri dönüştür"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', errors='replace')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class RetentionJob:
+    def __init__(self, archive_dir: str = ARCHIVE_DIR, retention_days: int = RETENTION_DAYS,
+                 batch_size: int = RETENTION_BATCH_SIZE, sleep_seconds: float = RETENTION_SLEEP_SECONDS,
+                 dry_run: bool = False):
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.sleep_seconds = sleep_seconds
+        self.dry_run = dry_run
+
+    def get_connection(self):
+        try:
+            return mysql.connector.connect(**DB_CONFIG)
+        except Error as e:
+            logger.error(f"Database connection error: {e}")
+            return None
+
+    def run(self) -> Dict:
+        cutoff = datetime.now() - timedelta(days=self.retention_days)
+        logger.info(f"Archiving messages created before {cutoff.isoformat()} into {self.archive_dir}")
+
+        conn = self.get_connection()
+        if not conn:
+            return {'success': False, 'error': 'Database connection failed'}
+
+        # Aynı mikrosaniyede başlayan iki çalıştırma bile farklı dosya adları üretir
+        run_id = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{uuid.uuid4().hex[:8]}"
+        totals = {'messages': 0, 'history': 0, 'analytics': 0, 'routing': 0, 'files': 0}
+        last_id = 0
+        locked = False
+
+        try:
+            # Her parça kendi kısa transaction'ında işlenir, böylece tablolar uzun süre kilitlenmez
+            conn.autocommit = True
+            cursor = conn.cursor(dictionary=True)
+
+            # cron ve --every aynı anda çalışırsa aynı satırları iki kez arşivlememek için
+            cursor.execute("SELECT GET_LOCK(%s, 0) AS acquired", (RETENTION_LOCK_NAME,))
+            locked = cursor.fetchone()['acquired'] == 1
+            if not locked:
+                logger.warning("Another retention run holds the lock, skipping this run")
+                cursor.close()
+                return {'success': False, 'error': 'Retention run already in progress', **totals}
+
+            links = self._child_links(cursor)
+
+            if not self.dry_run:
+                os.makedirs(self.archive_dir, exist_ok=True)
+
+            while True:
+                cursor.execute(
+                    """
+                    SELECT * FROM webhook_messages
+                    WHERE created_at < %s AND id > %s
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (cutoff, last_id, self.batch_size)
+                )
+                messages = cursor.fetchall()
+                if not messages:
+                    break
+
+                last_id = messages[-1]['id']
+                children = {
+                    key: self._fetch_children(cursor, table, links[table], messages)
+                    for table, key in CHILD_TABLES if table in links
+                }
+
+                totals['messages'] += len(messages)
+                for key, rows in children.items():
+                    totals[key] += len(rows)
+                history_count = len(children.get('history', []))
+
+                if self.dry_run:
+                    # Kuru çalıştırma hiçbir şey yazmaz; aksi halde gerçek çalıştırma ile çift kayıt oluşur
+                    logger.info(f"Dry run: would archive {len(messages)} messages, {history_count} history rows")
+                else:
+                    path = os.path.join(self.archive_dir,
+                                        f"{ARCHIVE_PREFIX}{run_id}_{totals['files']:05d}.ndjson.gz")
+                    try:
+                        self._write_chunk(path, messages, children, links)
+                    except OSError:
+                        totals['messages'] -= len(messages)
+                        for key, rows in children.items():
+                            totals[key] -= len(rows)
+                        raise
+                    try:
+                        deleted = self._delete_chunk(conn, cursor, messages, children, links)
+                    except Error:
+                        # Silme geri alındı (ör. kilit bekleme zaman aşımı); satırlar sıcak tablolarda
+                        # kaldığı için arşivi de silinir, yoksa sonraki çalıştırma onları ikinci kez arşivler
+                        self._discard_chunk(path)
+                        totals['messages'] -= len(messages)
+                        for key, rows in children.items():
+                            totals[key] -= len(rows)
+                        raise
+                    if not deleted:
+                        # Arşivden sonra yeni alt satır eklendi; parça silinmedi, arşivi de geri al
+                        self._discard_chunk(path)
+                        for key, rows in children.items():
+                            totals[key] -= len(rows)
+                        totals['messages'] -= len(messages)
+                        continue
+                    totals['files'] += 1
+                    logger.info(f"Archived chunk {path}: {len(messages)} messages, {history_count} history rows")
+
+                if len(messages) < self.batch_size:
+                    break
+                time.sleep(self.sleep_seconds)
+
+            cursor.close()
+            logger.info(f"Retention run finished: {totals}")
+            return {'success': True, 'cutoff': cutoff.isoformat(), 'dry_run': self.dry_run, **totals}
+
+        except (Error, OSError) as e:
+            logger.error(f"Retention run failed: {e}")
+            return {'success': False, 'error': str(e), **totals}
+        finally:
+            if locked:
+                try:
+                    release = conn.cursor()
+                    release.execute("SELECT RELEASE_LOCK(%s)", (RETENTION_LOCK_NAME,))
+                    release.fetchall()
+                    release.close()
+                except Error as e:
+                    logger.error(f"Failed to release retention lock: {e}")
+            conn.close()
+
+    def _child_links(self, cursor) -> Dict[str, Tuple[str, str]]:
+        """Alt tabloların webhook_messages'a hangi kolonla bağlandığını bul
+
+        izer_webhook_schema.sql `webhook_message_id` -> webhook_messages.id kullanır,
+        uygulama kodu ise `message_id` -> webhook_messages.message_id yazar.
+        """
+        table_names = [table for table, _ in CHILD_TABLES]
+        placeholders = ', '.join(['%s'] * len(table_names))
+        cursor.execute(
+            f"""
+            SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE()
+              AND TABLE_NAME IN ({placeholders})
+              AND COLUMN_NAME IN ('webhook_message_id', 'message_id')
+            """,
+            tuple(table_names)
+        )
+
+        columns: Dict[str, set] = {}
+        for row in cursor.fetchall():
+            columns.setdefault(row['table_name'], set()).add(row['column_name'])
+
+        links = {}
+        for table in table_names:
+            if 'webhook_message_id' in columns.get(table, ()):
+                links[table] = ('webhook_message_id', 'id')
+            elif 'message_id' in columns.get(table, ()):
+                links[table] = ('message_id', 'message_id')
+            else:
+                logger.warning(f"{table} is missing or has no link column to webhook_messages, it will not be archived")
+        return links
+
+    def _fetch_children(self, cursor, table: str, link: Tuple[str, str], messages: List[Dict]) -> List[Dict]:
+        column, parent_key = link
+        values = [message[parent_key] for message in messages]
+        placeholders = ', '.join(['%s'] * len(values))
+        cursor.execute(f"SELECT * FROM {table} WHERE {column} IN ({placeholders})", tuple(values))
+        return cursor.fetchall()
+
+    def _write_chunk(self, path: str, messages: List[Dict], children: Dict[str, List[Dict]],
+                     links: Dict[str, Tuple[str, str]]) -> None:
+        grouped: Dict[str, Tuple[str, Dict[Any, List[Dict]]]] = {}
+        for table, key in CHILD_TABLES:
+            if key not in children:
+                continue
+            column, parent_key = links[table]
+            rows_by_parent: Dict[Any, List[Dict]] = {}
+            for row in children[key]:
+                rows_by_parent.setdefault(row[column], []).append(row)
+            grouped[key] = (parent_key, rows_by_parent)
+
+        # Arşiv önce geçici dosyaya yazılır; silme işlemi yalnızca dosya tamamlandıktan sonra yapılır
+        if os.path.exists(path):
+            raise FileExistsError(f"Archive {path} already exists")
+
+        tmp_path = f"{path}.tmp"
+        try:
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as archive:
+                for message in messages:
+                    record = {'message': message}
+                    for key, (parent_key, rows_by_parent) in grouped.items():
+                        record[key] = rows_by_parent.get(message[parent_key], [])
+                    archive.write(json.dumps(record, ensure_ascii=False, default=_json_default) + '\n')
+            os.replace(tmp_path, path)
+
+            # Okuyucunun ilgisiz arşivleri açmaması için küçük bir yan indeks dosyası
+            index = {
+                'phone_numbers': sorted({m.get('phone_number') or '' for m in messages}),
+                'chat_names': sorted({m.get('chat_name') or '' for m in messages}),
+                'message_ids': [m['message_id'] for m in messages]
+            }
+            with open(f"{path}.idx.json", 'w', encoding='utf-8') as index_file:
+                json.dump(index, index_file, ensure_ascii=False)
+        except Exception:
+            # Yarım kalan dosyalar (ör. disk dolu) bırakılmaz; satırlar silinmediği için sonraki çalıştırma yeniden dener
+            self._discard_chunk(path)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _discard_chunk(self, path: str) -> None:
+        for file_path in (path, f"{path}.idx.json"):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def _delete_chunk(self, conn, cursor, messages: List[Dict], children: Dict[str, List[Dict]],
+                      links: Dict[str, Tuple[str, str]]) -> bool:
+        placeholders = ', '.join(['%s'] * len(messages))
+
+        conn.start_transaction()
+        try:
+            # Alt satırlar kilitlenip arşivlenenlerle karşılaştırılır; arşivde olmayan bir satırı
+            # (açık DELETE ya da ON DELETE CASCADE ile) silmektense parça atlanır
+            for table, key in CHILD_TABLES:
+                if table not in links:
+                    continue
+                column, parent_key = links[table]
+                values = tuple(message[parent_key] for message in messages)
+                cursor.execute(f"SELECT id FROM {table} WHERE {column} IN ({placeholders}) FOR UPDATE", values)
+                current_ids = {row['id'] for row in cursor.fetchall()}
+                if current_ids != {row['id'] for row in children[key]}:
+                    logger.warning(f"{table} changed after chunk was archived, skipping chunk")
+                    conn.rollback()
+                    return False
+                cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({placeholders})", values)
+
+            cursor.execute(f"DELETE FROM webhook_messages WHERE id IN ({placeholders})",
+                           tuple(message['id'] for message in messages))
+            conn.commit()
+            return True
+        except Error:
+            conn.rollback()
+            raise
+
+
+class ArchiveReader:
+    def __init__(self, archive_dir: str = ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+
+    def _archive_files(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.archive_dir, f"{ARCHIVE_PREFIX}*.ndjson.gz")))
+
+    def _matches_index(self, path: str, phone_number: Optional[str], chat_name: Optional[str]) -> bool:
+        try:
+            with open(f"{path}.idx.json", 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            # İndeks yoksa dosyayı taramak zorundayız
+            return True
+
+        return ((phone_number is not None and phone_number in index.get('phone_numbers', [])) or
+                (chat_name is not None and chat_name in index.get('chat_names', [])))
+
+    def iter_records(self, phone_number: Optional[str] = None, chat_name: Optional[str] = None) -> Iterator[Dict]:
+        # Bir message_id yalnızca bir kez döndürülür; aynı mesaj elle kopyalanmış arşivlerde tekrar edebilir
+        seen = set()
+        for path in self._archive_files():
+            if not self._matches_index(path, phone_number, chat_name):
+                continue
+
+            with gzip.open(path, 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    record = json.loads(line)
+                    message = record.get('message', {})
+                    if message.get('phone_number') != phone_number and message.get('chat_name') != chat_name:
+                        continue
+                    if message.get('message_id') in seen:
+                        continue
+                    seen.add(message.get('message_id'))
+                    yield record
+
+    def load_conversation(self, phone_number: Optional[str] = None, chat_name: Optional[str] = None) -> List[Dict]:
+        """Arşivlenmiş bir konuşmayı webhook formatında geri yükle"""
+        if phone_number is None and chat_name is None:
+            raise ValueError("phone_number or chat_name is required")
+
+        conversation = []
+        for record in self.iter_records(phone_number, chat_name):
+            message = record['message']
+            conversation.append({
+                'message_id': message.get('message_id'),
+                'chat_time': message.get('chat_time'),
+                'chat_name': message.get('chat_name'),
+                'phone_number': message.get('phone_number'),
+                'current_message': message.get('current_message'),
+                'history': [
+                    {
+                        'sender': row.get('sender'),
+                        'content': row.get('content'),
+                        'timestamp': row.get('timestamp'),
+                        'type': row.get('message_type', 'text')
+                    }
+                    for row in record.get('history', [])
+                ],
+                'analytics': record.get('analytics', []),
+                'routing': record.get('routing', [])
+            })
+
+        conversation.sort(key=lambda item: item.get('chat_time') or '')
+        return conversation
+
+
+def main():
+    parser = argparse.ArgumentParser(description='İzer webhook retention and archival job')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Archive and purge old messages')
+    run_parser.add_argument('--days', type=int, default=RETENTION_DAYS)
+    run_parser.add_argument('--batch-size', type=int, default=RETENTION_BATCH_SIZE)
+    run_parser.add_argument('--sleep', type=float, default=RETENTION_SLEEP_SECONDS)
+    run_parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    run_parser.add_argument('--dry-run', action='store_true', help='Report what would be archived without writing or deleting anything')
+    run_parser.add_argument('--every', type=int, default=0,
+                            help='Repeat the job every N seconds instead of running once')
+
+    restore_parser = subparsers.add_parser('restore', help='Print an archived conversation as JSON')
+    restore_parser.add_argument('--phone')
+    restore_parser.add_argument('--chat-name')
+    restore_parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+
+    args = parser.parse_args()
+
+    if args.command == 'restore':
+        reader = ArchiveReader(args.archive_dir)
+        conversation = reader.load_conversation(args.phone, args.chat_name)
+        print(json.dumps(conversation, ensure_ascii=False, indent=2))
+        return
+
+    job = RetentionJob(args.archive_dir, args.days, args.batch_size, args.sleep, args.dry_run)
+    while True:
+        job.run()
+        if args.every <= 0:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
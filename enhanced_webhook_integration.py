@@ -2,23 +2,29 @@
 
 import os
 import json
+import threading
+import time
 import requests
 import mysql.connector
+from mysql.connector import pooling
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, current_app, request, jsonify
 from typing import Dict, List, Any, Optional
 import logging
+from history_index import HistoryIndex
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('webhook_system.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def configure_logging():
+    logging.basicConfig(
+        level=os.getenv('LOG_LEVEL', 'INFO'),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(os.getenv('LOG_FILE', 'webhook_system.log')),
+            logging.StreamHandler()
+        ]
+    )
+
 class DatabaseManager:
     def __init__(self):
         self.config = {
@@ -29,10 +35,29 @@ class DatabaseManager:
             'charset': 'utf8mb4',
             'collation': 'utf8mb4_unicode_ci'
         }
+        self.pool_size = int(os.getenv('DB_POOL_SIZE', 5))
         self.connection_pool = None
+        self.pool_lock = threading.Lock()
+
+    def get_pool(self):
+        if self.connection_pool is None and self.pool_size > 0:
+            with self.pool_lock:
+                if self.connection_pool is None:
+                    self.connection_pool = pooling.MySQLConnectionPool(
+                        pool_name='izer_webhook',
+                        pool_size=self.pool_size,
+                        **self.config
+                    )
+        return self.connection_pool
 
     def get_connection(self):
         try:
+            pool = self.get_pool()
+            if pool:
+                try:
+                    return pool.get_connection()
+                except mysql.connector.errors.PoolError:
+                    logger.warning("Database connection pool exhausted, opening a direct connection")
             return mysql.connector.connect(**self.config)
         except mysql.connector.Error as e:
             logger.error(f"Database connection error: {e}")
@@ -132,9 +157,17 @@ class DatabaseManager:
         return self.execute_query(query, params) is not None
 
 class EnhancedWebhookProcessor:
-    def __init__(self):
-        self.db = DatabaseManager()
-        self.openai_api_key = os.getenv('OPENAI_API_KEY')
+    def __init__(self, db=None, openai_api_key: Optional[str] = None, http=None,
+                 history_index: Optional[HistoryIndex] = None):
+        self.db = db if db is not None else DatabaseManager()
+        self._http = http
+        self.history_index = history_index if history_index is not None else HistoryIndex(
+            max_per_conversation=int(os.getenv('HISTORY_INDEX_MAX_PER_CONVERSATION', 1000)),
+            max_conversations=int(os.getenv('HISTORY_INDEX_MAX_CONVERSATIONS', 10000))
+        )
+        self.history_top_k = int(os.getenv('HISTORY_TOP_K', 5))
+        self.history_index_ttl = int(os.getenv('HISTORY_INDEX_TTL_SECONDS', 3600))
+        self.openai_api_key = openai_api_key or os.getenv('OPENAI_API_KEY')
 
         if not self.openai_api_key:
             logger.error("OPENAI_API_KEY environment variable not set")
@@ -156,13 +189,19 @@ class EnhancedWebhookProcessor:
             '+905551234567', '+905551234568', '+905551234569'
         ]
 
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = requests.Session()
+        return self._http
+
     def analyze_message_with_history(self, message: Dict) -> Dict:
         try:
             current_msg = message.get('current_message', '')
             chat_name = message.get('chat_name', '')
             phone = message.get('phone_number', '')
 
-            message_history = self.get_relevant_history(phone, chat_name)
+            message_history = self.get_relevant_history(phone, chat_name, limit=self.history_top_k, query=current_msg)
             history_context = self.prepare_history_context(message_history)
 
             analysis_prompt = f"""
@@ -209,7 +248,7 @@ class EnhancedWebhookProcessor:
                 'max_tokens': 1000
             }
 
-            response = requests.post(
+            response = self.http.post(
                 'https://api.openai.com/v1/chat/completions',
                 headers=headers,
                 json=payload,
@@ -240,7 +279,39 @@ class EnhancedWebhookProcessor:
             logger.error(f"Error in message analysis: {e}")
             return self.get_fallback_analysis()
 
-    def get_relevant_history(self, phone: str, chat_name: str, limit: int = 10) -> List[Dict]:
+    def get_relevant_history(self, phone: str, chat_name: str, limit: int = 10,
+                             query: Optional[str] = None) -> List[Dict]:
+        if query is not None and self.history_index is not None:
+            self.sync_history_index(phone, chat_name)
+            return self.history_index.search(query, phone, chat_name, k=limit)
+
+        return self.get_recent_history(phone, chat_name, limit) or []
+
+    def sync_history_index(self, phone: str, chat_name: str) -> None:
+        # Other workers write history too, so every lookup first pulls rows newer than the last id seen.
+        # A periodic full reload also drops rows deleted elsewhere, e.g. by the retention job.
+        state = self.history_index.conversation_state(phone, chat_name)
+        full = state is None or time.time() - state['loaded_at'] > self.history_index_ttl
+        rows = self.get_history_since(phone, chat_name, 0 if full else state['last_id'])
+        if rows is None:
+            return
+
+        self.history_index.sync(phone, chat_name, rows, full=full)
+
+    def get_history_since(self, phone: str, chat_name: str, last_id: int) -> Optional[List[Dict]]:
+        # The connector resends recent history with every webhook, so identical lines are collapsed here
+        query = """
+        SELECT MIN(mh.id) AS first_id, MAX(mh.id) AS last_id, mh.sender, mh.content, mh.timestamp, mh.message_type
+        FROM message_history mh
+        JOIN webhook_messages wm ON mh.message_id = wm.message_id
+        WHERE (wm.phone_number = %s OR wm.chat_name = %s) AND mh.id > %s
+        GROUP BY mh.sender, mh.content, mh.timestamp, mh.message_type
+        ORDER BY first_id
+        """
+
+        return self.db.execute_query(query, (phone, chat_name, last_id))
+
+    def get_recent_history(self, phone: str, chat_name: str, limit: int) -> Optional[List[Dict]]:
         query = """
         SELECT mh.sender, mh.content, mh.timestamp, mh.message_type
         FROM message_history mh
@@ -250,15 +321,15 @@ class EnhancedWebhookProcessor:
         LIMIT %s
         """
 
-        result = self.db.execute_query(query, (phone, chat_name, limit))
-        return result if result else []
+        return self.db.execute_query(query, (phone, chat_name, limit))
 
     def prepare_history_context(self, history: List[Dict]) -> str:
         if not history:
             return "No previous conversation history available."
 
         context_lines = []
-        for msg in reversed(history[-5:]):  # Last 5 messages
+        # Geçmiş en yeniden eskiye gelir; ilk HISTORY_TOP_K mesaj kronolojik sıraya çevrilir
+        for msg in reversed(history[:self.history_top_k]):
             timestamp = msg.get('timestamp', '')
             sender = msg.get('sender', 'Unknown')
             content = msg.get('content', '')
@@ -307,7 +378,7 @@ class EnhancedWebhookProcessor:
                 }
             }
 
-            response = requests.post(
+            response = self.http.post(
                 f"{agent_config['url']}/process",
                 json=payload,
                 timeout=30
@@ -345,7 +416,14 @@ class EnhancedWebhookProcessor:
                 return {'success': False, 'error': 'Database save failed'}
 
             if 'history' in webhook_data:
-                self.db.save_message_history(message_id, webhook_data['history'])
+                history_saved = self.db.save_message_history(message_id, webhook_data['history'])
+                # Only index what is actually in the database, or the index would serve phantom history
+                if history_saved and self.history_index is not None:
+                    self.history_index.add(
+                        webhook_data.get('phone_number', ''),
+                        webhook_data.get('chat_name', ''),
+                        webhook_data['history']
+                    )
 
             analysis = self.analyze_message_with_history(webhook_data)
 
@@ -372,10 +450,54 @@ class EnhancedWebhookProcessor:
                 'error': str(e)
             }
 
-app = Flask(__name__)
-processor = EnhancedWebhookProcessor()
-
-@app.route('/webhook', methods=['POST'])
+def build_database(backend: Optional[str] = None):
+    backend = backend or os.getenv('DB_BACKEND', 'mysql')
+
+    if backend == 'sqlite':
+        from sqlite_database import SQLiteDatabase
+        return SQLiteDatabase(os.getenv('DB_SQLITE_PATH', 'izer_webhook_system.sqlite3'))
+    if backend == 'memory':
+        from sqlite_database import SQLiteDatabase
+        return SQLiteDatabase(':memory:')
+    if backend == 'mysql':
+        return DatabaseManager()
+
+    raise ValueError(f"Unknown database backend: {backend}")
+
+class WebhookServices:
+    """Lazily constructed subsystems shared by the web app, workers and CLI tools."""
+
+    def __init__(self, db_backend: Optional[str] = None, db=None, processor: Optional[EnhancedWebhookProcessor] = None,
+                 http=None):
+        self.db_backend = db_backend
+        self._db = db
+        self._processor = processor
+        self._http = http
+        self.lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self.lock:
+                if self._db is None:
+                    self._db = build_database(self.db_backend)
+        return self._db
+
+    @property
+    def processor(self) -> EnhancedWebhookProcessor:
+        if self._processor is None:
+            db = self.db
+            with self.lock:
+                if self._processor is None:
+                    self._processor = EnhancedWebhookProcessor(db=db, http=self._http)
+        return self._processor
+
+webhook_api = Blueprint('webhook_api', __name__)
+
+def get_services() -> WebhookServices:
+    return current_app.extensions['webhook_services']
+
+@webhook_api.route('/webhook', methods=['POST'])
 def handle_webhook():
     try:
         data = request.get_json()
@@ -383,7 +505,7 @@ def handle_webhook():
         if not data:
             return jsonify({'error': 'No JSON data provided'}), 400
 
-        result = processor.process_webhook(data)
+        result = get_services().processor.process_webhook(data)
 
         if result['success']:
             return jsonify(result), 200
@@ -394,7 +516,7 @@ def handle_webhook():
         logger.error(f"Webhook endpoint error: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/health', methods=['GET'])
+@webhook_api.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
@@ -402,7 +524,7 @@ def health_check():
         'timestamp': datetime.now().isoformat()
     })
 
-@app.route('/stats', methods=['GET'])
+@webhook_api.route('/stats', methods=['GET'])
 def get_stats():
     try:
         stats_query = """
@@ -411,10 +533,10 @@ def get_stats():
             SUM(CASE WHEN processed = 1 THEN 1 ELSE 0 END) as processed_messages,
             SUM(CASE WHEN processed = 0 THEN 1 ELSE 0 END) as pending_messages
         FROM webhook_messages
-        WHERE created_at >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
+        WHERE created_at >= %s
         """
 
-        stats = processor.db.execute_query(stats_query)
+        stats = get_services().db.execute_query(stats_query, (datetime.now() - timedelta(hours=24),))
 
         if stats and len(stats) > 0:
             return jsonify({
@@ -435,6 +557,29 @@ def get_stats():
         logger.error(f"Error getting stats: {e}")
         return jsonify({'error': str(e)}), 500
 
+def create_app(services: Optional[WebhookServices] = None, configure_logs: bool = True) -> Flask:
+    # Tools and tests that embed the app pass configure_logs=False to keep their own logging setup
+    if configure_logs:
+        configure_logging()
+
+    app = Flask(__name__)
+    app.extensions['webhook_services'] = services or WebhookServices()
+    app.register_blueprint(webhook_api)
+    return app
+
+_default_app = None
+
+def __getattr__(name: str):
+    # `app` and `processor` are still importable, but only built on first access
+    global _default_app
+    if name in ('app', 'processor'):
+        if _default_app is None:
+            _default_app = create_app()
+        if name == 'app':
+            return _default_app
+        return _default_app.extensions['webhook_services'].processor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8100))
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
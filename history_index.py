@@ -0,0 +1,271 @@
+import heapq
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Türkçe karakterler ASCII'ye katlanır; müşteriler çoğu zaman "ş" yerine "s" yazıyor
+TURKISH_FOLD = str.maketrans({
+    'ı': 'i', 'ğ': 'g', 'ü': 'u', 'ş': 's', 'ö': 'o', 'ç': 'c',
+    'â': 'a', 'î': 'i', 'û': 'u'
+})
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Türkçe için yaygın kullanılan ilk-5-karakter kökleme: "bisikletimin" ve "bisiklet" aynı terime düşer
+STEM_LENGTH = 5
+
+STOPWORDS = {
+    'acaba', 'ama', 'ancak', 'bana', 'ben', 'benim', 'beni', 'bir', 'biz', 'bu', 'bunu', 'da', 'de', 'daha',
+    'diye', 'en', 'gibi', 'hem', 'hep', 'her', 'icin', 'ile', 'ise', 'kadar', 'ki', 'mi', 'mu', 'ne', 'o',
+    'sen', 'siz', 'sizin', 'size', 've', 'veya', 'ya', 'yani', 'cok', 'var', 'yok', 'merhaba', 'selam',
+    'the', 'and', 'is', 'to', 'a', 'of'
+}
+
+
+def normalize_turkish(text: str) -> List[str]:
+    """Metni Türkçe kurallarına göre küçült, katla ve köklerine ayır"""
+    text = (text or '').replace('I', 'ı').replace('İ', 'i').lower().translate(TURKISH_FOLD)
+    return [token[:STEM_LENGTH] for token in TOKEN_PATTERN.findall(text)
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+def timestamp_key(value) -> str:
+    """Veritabanı ve webhook zaman damgalarını karşılaştırılabilir tek bir biçime getir"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value or '')
+
+
+class HistoryIndex:
+    """In-memory BM25 index over message history, kept per conversation and updated on every save.
+
+    A message belongs to the conversations of both its phone number and its chat name, matching the
+    `phone_number = %s OR chat_name = %s` filter used for SQL history lookups. Each distinct message
+    (sender, content, timestamp) is stored once and shared by every conversation it was synced into,
+    so group chats do not see the same line twice and BM25 document counts stay accurate.
+
+    Each synced conversation remembers the highest `message_history.id` it has seen, so callers can
+    fetch only newer rows (written by other processes) before searching, and the time it was last
+    fully loaded, so rows deleted elsewhere (e.g. by the retention job) drop out after a reload.
+
+    Memory is bounded twice: a conversation over `max_per_conversation` messages drops its
+    shortest messages first (never the `keep_recent` newest), so early context such as the bike
+    that was bought survives; beyond `max_conversations` the least recently used conversation is dropped.
+    """
+
+    def __init__(self, max_per_conversation: int = 1000, max_conversations: int = 10000, keep_recent: int = 20,
+                 k1: float = 1.5, b: float = 0.75):
+        self.max_per_conversation = max_per_conversation
+        self.max_conversations = max_conversations
+        self.keep_recent = keep_recent
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+
+        self.next_id = 0
+        self.documents: Dict[int, Dict] = {}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.total_length = 0
+        self.by_phone: Dict[str, Dict[int, None]] = {}
+        self.by_chat: Dict[str, Dict[int, None]] = {}
+        self.by_pair: Dict[Tuple[str, str], Dict[int, None]] = {}
+        self.fingerprints: Dict[Tuple, int] = {}
+        self.sync_state: Dict[Tuple[str, str], Dict] = {}
+        self.recently_used: OrderedDict = OrderedDict()
+
+    def conversation_state(self, phone: str, chat_name: str) -> Optional[Dict]:
+        """Return the sync state ({'last_id', 'loaded_at'}) of a conversation, or None if never synced"""
+        with self.lock:
+            state = self.sync_state.get((phone, chat_name))
+            return dict(state) if state is not None else None
+
+    def sync(self, phone: str, chat_name: str, rows: List[Dict], full: bool = False) -> int:
+        """Apply rows fetched from message_history; each row must carry its `last_id`
+
+        A full sync replaces everything indexed for the conversation, so rows deleted from the
+        database disappear from the index as well.
+        """
+        pair = (phone, chat_name)
+        with self.lock:
+            state = self.sync_state.get(pair)
+            if full or state is None:
+                for doc_id in list(self.by_pair.get(pair, ())):
+                    self._detach(doc_id, pair)
+                state = {'last_id': 0, 'loaded_at': time.time()}
+                self.sync_state[pair] = state
+
+            added = self._add(phone, chat_name, rows)
+            for row in rows:
+                state['last_id'] = max(state['last_id'], int(row.get('last_id') or 0))
+            return added
+
+    def add(self, phone: str, chat_name: str, messages: Iterable[Dict]) -> int:
+        with self.lock:
+            return self._add(phone, chat_name, messages)
+
+    def _touch(self, pair: Tuple[str, str]) -> None:
+        self.recently_used[pair] = None
+        self.recently_used.move_to_end(pair)
+        while len(self.recently_used) > self.max_conversations:
+            stale, _ = self.recently_used.popitem(last=False)
+            self.sync_state.pop(stale, None)
+            for doc_id in list(self.by_pair.get(stale, ())):
+                self._detach(doc_id, stale)
+
+    def _trim(self, pair: Tuple[str, str]) -> None:
+        conversation = self.by_pair.get(pair)
+        if not conversation or len(conversation) <= self.max_per_conversation:
+            return
+
+        excess = len(conversation) - self.max_per_conversation
+        doc_ids = sorted(conversation)
+        keep_recent = min(self.keep_recent, self.max_per_conversation)
+        evictable = doc_ids[:len(doc_ids) - keep_recent]
+        # Kısa mesajlar ("tamam", "teşekkürler") erken bağlamdan önce gider
+        for doc_id in heapq.nsmallest(excess, evictable, key=lambda d: (self.documents[d]['length'], d)):
+            self._detach(doc_id, pair)
+
+    def _add(self, phone: str, chat_name: str, messages: Iterable[Dict]) -> int:
+        pair = (phone, chat_name)
+        self._touch(pair)
+        added = 0
+        for msg in messages:
+            content = msg.get('content', '') or ''
+            # Kimlik konuşmayı içermez: aynı satır hem telefonun hem grubun konuşmasında tek belgedir
+            fingerprint = (msg.get('sender', ''), content, timestamp_key(msg.get('timestamp')))
+            doc_id = self.fingerprints.get(fingerprint)
+            if doc_id is not None:
+                if pair not in self.documents[doc_id]['pairs']:
+                    self._attach(doc_id, pair)
+                    added += 1
+                continue
+
+            terms: Dict[str, int] = {}
+            for term in normalize_turkish(content):
+                terms[term] = terms.get(term, 0) + 1
+
+            doc_id = self.next_id
+            self.next_id += 1
+            self.documents[doc_id] = {
+                'row': {
+                    'sender': msg.get('sender', ''),
+                    'content': content,
+                    'timestamp': msg.get('timestamp', ''),
+                    'message_type': msg.get('message_type', msg.get('type', 'text'))
+                },
+                'terms': terms,
+                'length': sum(terms.values()),
+                'pairs': set(),
+                'fingerprint': fingerprint
+            }
+            self.fingerprints[fingerprint] = doc_id
+            self.total_length += self.documents[doc_id]['length']
+            for term, count in terms.items():
+                self.postings.setdefault(term, {})[doc_id] = count
+
+            self._attach(doc_id, pair)
+            added += 1
+
+        self._trim(pair)
+        return added
+
+    def _attach(self, doc_id: int, pair: Tuple[str, str]) -> None:
+        self.documents[doc_id]['pairs'].add(pair)
+        self.by_pair.setdefault(pair, {})[doc_id] = None
+        for key, conversations in ((pair[0], self.by_phone), (pair[1], self.by_chat)):
+            if key:
+                conversations.setdefault(key, {})[doc_id] = None
+
+    def _detach(self, doc_id: int, pair: Tuple[str, str]) -> None:
+        """Remove a message from one conversation; it is dropped once no conversation holds it"""
+        pairs = self.documents[doc_id]['pairs']
+        pairs.discard(pair)
+        self._unlink(self.by_pair, pair, doc_id)
+        if not any(other[0] == pair[0] for other in pairs):
+            self._unlink(self.by_phone, pair[0], doc_id)
+        if not any(other[1] == pair[1] for other in pairs):
+            self._unlink(self.by_chat, pair[1], doc_id)
+        if not pairs:
+            self._remove(doc_id)
+
+    def _unlink(self, conversations: Dict, key, doc_id: int) -> None:
+        conversation = conversations.get(key)
+        if conversation is not None:
+            conversation.pop(doc_id, None)
+            if not conversation:
+                del conversations[key]
+
+    def _remove(self, doc_id: int) -> None:
+        document = self.documents.pop(doc_id)
+        self.total_length -= document['length']
+        self.fingerprints.pop(document['fingerprint'], None)
+
+        for term in document['terms']:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+
+    def _conversation_ids(self, phone: str, chat_name: str) -> Set[int]:
+        doc_ids = set(self.by_phone.get(phone, ()))
+        doc_ids.update(self.by_chat.get(chat_name, ()))
+        return doc_ids
+
+    def search(self, query: str, phone: str, chat_name: str, k: int = 5) -> List[Dict]:
+        """Return the k most relevant messages of a conversation, newest first.
+
+        When fewer than k messages share terms with the query the result is topped up
+        with the most recent messages of the conversation.
+        """
+        query_terms = set(normalize_turkish(query))
+
+        with self.lock:
+            if (phone, chat_name) in self.recently_used:
+                self.recently_used.move_to_end((phone, chat_name))
+            candidates = self._conversation_ids(phone, chat_name)
+            if not candidates:
+                return []
+
+            total_docs = len(self.documents)
+            average_length = self.total_length / total_docs if total_docs else 0.0
+            scores: Dict[int, float] = {}
+
+            for term in query_terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+
+                idf = math.log(1 + (total_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                # Küçük konuşmalarda konuşmayı, yaygın terimlerde ise posting listesini dolaşmak daha ucuz
+                if len(candidates) < len(posting):
+                    matches = ((doc_id, posting[doc_id]) for doc_id in candidates if doc_id in posting)
+                else:
+                    matches = ((doc_id, tf) for doc_id, tf in posting.items() if doc_id in candidates)
+
+                for doc_id, tf in matches:
+                    length_norm = 1 - self.b + self.b * self.documents[doc_id]['length'] / (average_length or 1.0)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+
+            selected = sorted(scores, key=lambda doc_id: (scores[doc_id], doc_id), reverse=True)[:k]
+            if len(selected) < k:
+                chosen = set(selected)
+                for doc_id in sorted(candidates, reverse=True):
+                    if len(selected) >= k:
+                        break
+                    if doc_id not in chosen:
+                        selected.append(doc_id)
+
+            rows = [dict(self.documents[doc_id]['row']) for doc_id in selected]
+
+        rows.sort(key=lambda row: timestamp_key(row.get('timestamp')), reverse=True)
+        return rows
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Kaydedilmiş webhook mesajlarını çevrimdışı olarak işleme hattından geçiren replay aracı
+MySQL ve OpenAI olmadan gecikme regresyonlarını yeniden üretmek ve profillemek için kullanılır.
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+from enhanced_webhook_integration import EnhancedWebhookProcessor
+from sqlite_database import SQLiteDatabase
+
+OPENAI_URL = 'https://api.openai.com/v1/chat/completions'
+
+
+def load_ndjson(path: str) -> List[Dict]:
+    """NDJSON dosyasını satır satır oku"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+class RecordedResponse:
+    def __init__(self, status_code: int, body: Any):
+        self.status_code = status_code
+        self.body = body
+        self.text = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+
+    def json(self) -> Any:
+        return json.loads(self.text) if isinstance(self.body, str) else self.body
+
+
+class RecordedHttpClient:
+    """Stands in for `requests`, answering each URL from recorded responses in order.
+
+    Recordings are NDJSON lines of the form
+    {"url": ..., "status_code": 200, "body": {...}, "latency_ms": 0}.
+    The last recording for a URL is reused once its queue runs dry; URLs without
+    recordings get a canned successful response.
+    """
+
+    def __init__(self, recordings: Optional[List[Dict]] = None, simulate_latency: bool = False,
+                 default_analysis: Optional[Dict] = None):
+        self.simulate_latency = simulate_latency
+        self.default_analysis = default_analysis or {}
+        self.recordings: Dict[str, deque] = {}
+        for recording in recordings or []:
+            self.recordings.setdefault(recording['url'], deque()).append(recording)
+
+    def default_recording(self, url: str) -> Dict:
+        if url == OPENAI_URL:
+            content = json.dumps(self.default_analysis)
+            return {'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}}
+        return {'status_code': 200, 'body': {'status': 'replayed'}}
+
+    def post(self, url: str, **kwargs) -> RecordedResponse:
+        queue = self.recordings.get(url)
+        if queue:
+            recording = queue.popleft() if len(queue) > 1 else queue[0]
+        else:
+            recording = self.default_recording(url)
+
+        if self.simulate_latency and recording.get('latency_ms'):
+            time.sleep(recording['latency_ms'] / 1000.0)
+
+        return RecordedResponse(recording.get('status_code', 200), recording.get('body', {}))
+
+
+class StageProfiler:
+    """Wraps processor and backend methods to record per-stage time and net allocations per message."""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.records: List[Dict] = []
+        self.current: Optional[Dict] = None
+
+    def wrap(self, owner: Any, method_name: str, stage: str) -> None:
+        method = getattr(owner, method_name)
+
+        @wraps(method)
+        def timed(*args, **kwargs):
+            if self.current is None:
+                return method(*args, **kwargs)
+
+            memory_before = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                stats = self.current['stages'].setdefault(stage, {'calls': 0, 'seconds': 0.0, 'alloc_bytes': 0})
+                stats['calls'] += 1
+                stats['seconds'] += elapsed
+                if self.trace_memory:
+                    stats['alloc_bytes'] += tracemalloc.get_traced_memory()[0] - memory_before
+
+        setattr(owner, method_name, timed)
+
+    def begin_message(self, message_id: str) -> None:
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.current = {
+            'message_id': message_id,
+            'stages': {},
+            'memory_before': tracemalloc.get_traced_memory()[0] if self.trace_memory else 0,
+            'started': time.perf_counter()
+        }
+
+    def end_message(self, success: bool, error: Optional[str] = None) -> None:
+        record = self.current
+        record['total_seconds'] = time.perf_counter() - record.pop('started')
+        memory_before = record.pop('memory_before')
+        record['success'] = success
+        if not success:
+            record['error'] = error
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['alloc_bytes'] = current - memory_before
+            record['peak_bytes'] = peak
+        self.records.append(record)
+        self.current = None
+
+    def successful_records(self) -> List[Dict]:
+        return [record for record in self.records if record['success']]
+
+    def failed_records(self) -> List[Dict]:
+        return [record for record in self.records if not record['success']]
+
+    def summary(self) -> Dict[str, Dict]:
+        # Başarısız mesajlar hattı erken terk eder; ölçüme katılırlarsa sahte bir hızlanma gösterirler
+        records = self.successful_records()
+        stages: Dict[str, Dict] = {}
+        for record in records:
+            for stage, stats in list(record['stages'].items()) + [('total', {
+                'calls': 1, 'seconds': record['total_seconds'], 'alloc_bytes': record.get('alloc_bytes', 0)
+            })]:
+                entry = stages.setdefault(stage, {'calls': 0, 'timings_ms': [], 'alloc_bytes': 0})
+                entry['calls'] += stats['calls']
+                entry['timings_ms'].append(stats['seconds'] * 1000.0)
+                entry['alloc_bytes'] += stats['alloc_bytes']
+
+        count = len(records) or 1
+        summary = {}
+        for stage, entry in stages.items():
+            timings = sorted(entry['timings_ms'])
+            summary[stage] = {
+                'calls': entry['calls'],
+                'mean_ms': statistics.mean(timings),
+                'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+                'max_ms': timings[-1],
+                'alloc_kib_per_message': entry['alloc_bytes'] / 1024.0 / count
+            }
+        return summary
+
+    def print_report(self) -> None:
+        failed = self.failed_records()
+        print(f"\nReplayed {len(self.records)} messages "
+              f"({len(self.records) - len(failed)} successful, {len(failed)} failed)")
+        if failed:
+            print("Failed messages are excluded from the stage statistics:")
+            for record in failed:
+                print(f"  {record['message_id']}: {record.get('error')}")
+        print(f"{'stage':<16}{'calls':>8}{'mean ms':>12}{'p95 ms':>12}{'max ms':>12}", end='')
+        print(f"{'KiB/msg':>12}" if self.trace_memory else '')
+        for stage, stats in self.summary().items():
+            print(f"{stage:<16}{stats['calls']:>8}{stats['mean_ms']:>12.2f}"
+                  f"{stats['p95_ms']:>12.2f}{stats['max_ms']:>12.2f}", end='')
+            print(f"{stats['alloc_kib_per_message']:>12.1f}" if self.trace_memory else '')
+        if self.trace_memory and self.successful_records():
+            peak = max(record['peak_bytes'] for record in self.successful_records())
+            print(f"Peak traced memory during a single message: {peak / 1024.0:.1f} KiB")
+        print("Stage times are inclusive: 'analyze' contains 'history_lookup' and the OpenAI 'upstream' call.")
+
+
+def expand_payloads(payloads: List[Dict], repeat: int) -> List[Dict]:
+    """Payload listesini tekrarla; her tekrara benzersiz message_id ver"""
+    expanded = []
+    for round_number in range(repeat):
+        for index, payload in enumerate(payloads):
+            payload = dict(payload)
+            message_id = payload.get('message_id') or f"replay_{index}"
+            # message_id UNIQUE olduğu için aynı kimlik ikinci kez kaydedilemez
+            payload['message_id'] = message_id if round_number == 0 else f"{message_id}_r{round_number}"
+            expanded.append(payload)
+    return expanded
+
+
+def prepare_sqlite_file(path: Optional[str], force: bool = False) -> str:
+    """Replay için boş bir SQLite dosyası hazırla; yol verilmezse geçici bir dizinde oluşturulur"""
+    if not path:
+        return os.path.join(tempfile.mkdtemp(prefix='replay_'), 'replay.sqlite3')
+
+    # Önceki satırlar message_id çakışmasına yol açar, ama replay'in oluşturmadığı bir dosya
+    # (ör. DB_SQLITE_PATH) yalnızca açıkça istenirse silinir
+    existing = [path + suffix for suffix in ('', '-journal', '-wal', '-shm') if os.path.exists(path + suffix)]
+    if existing and not force:
+        raise FileExistsError(f"{path} already exists; choose a new --sqlite-path or pass --force to overwrite it")
+    for file_path in existing:
+        os.remove(file_path)
+    return path
+
+
+def build_processor(backend: str, sqlite_path: str, http: RecordedHttpClient) -> EnhancedWebhookProcessor:
+    db = SQLiteDatabase(sqlite_path if backend == 'sqlite' else ':memory:')
+    processor = EnhancedWebhookProcessor(db=db, openai_api_key='replay', http=http)
+    if not http.default_analysis:
+        http.default_analysis = processor.get_fallback_analysis()
+    return processor
+
+
+def instrument(processor: EnhancedWebhookProcessor, profiler: StageProfiler) -> None:
+    profiler.wrap(processor.db, 'save_webhook_message', 'save_message')
+    profiler.wrap(processor.db, 'save_message_history', 'save_history')
+    profiler.wrap(processor, 'analyze_message_with_history', 'analyze')
+    profiler.wrap(processor, 'get_relevant_history', 'history_lookup')
+    profiler.wrap(processor.http, 'post', 'upstream')
+    profiler.wrap(processor.db, 'save_analytics_result', 'save_analytics')
+    profiler.wrap(processor, 'route_to_agent', 'route')
+
+
+def replay(processor: EnhancedWebhookProcessor, payloads: List[Dict], profiler: StageProfiler) -> None:
+    for payload in payloads:
+        profiler.begin_message(payload.get('message_id', ''))
+        result = processor.process_webhook(payload)
+        profiler.end_message(result.get('success', False), result.get('error'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded webhook payloads through the processing pipeline')
+    parser.add_argument('payloads', help='NDJSON file with one webhook payload per line')
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--sqlite-path',
+                        help='New SQLite file for --backend sqlite (default: a file in a fresh temporary directory)')
+    parser.add_argument('--force', action='store_true',
+                        help='Delete an existing --sqlite-path (and its -wal/-shm/-journal files) before replaying')
+    parser.add_argument('--responses', help='NDJSON file with recorded upstream HTTP responses')
+    parser.add_argument('--simulate-latency', action='store_true',
+                        help='Sleep for the recorded latency_ms of each upstream response')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Replay the payload file N times, suffixing message_id with _rN after the first pass')
+    parser.add_argument('--cprofile', metavar='PATH', help='Write cProfile stats to PATH and print the top entries')
+    parser.add_argument('--tracemalloc', action='store_true', help='Track allocations per stage')
+    parser.add_argument('--json-report', metavar='PATH', help='Write per-message stage records as JSON')
+    args = parser.parse_args()
+
+    payloads = expand_payloads(load_ndjson(args.payloads), args.repeat)
+    recordings = load_ndjson(args.responses) if args.responses else []
+
+    sqlite_path = None
+    if args.backend == 'sqlite':
+        try:
+            sqlite_path = prepare_sqlite_file(args.sqlite_path, force=args.force)
+        except FileExistsError as e:
+            parser.error(str(e))
+
+    http = RecordedHttpClient(recordings, simulate_latency=args.simulate_latency)
+    processor = build_processor(args.backend, sqlite_path, http)
+    profiler = StageProfiler(trace_memory=args.tracemalloc)
+    instrument(processor, profiler)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    profile = cProfile.Profile() if args.cprofile else None
+    if profile:
+        profile.enable()
+    try:
+        replay(processor, payloads, profiler)
+    finally:
+        if profile:
+            profile.disable()
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+    profiler.print_report()
+    if sqlite_path:
+        print(f"SQLite database: {sqlite_path}")
+
+    if profile:
+        profile.dump_stats(args.cprofile)
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(25)
+        print(output.getvalue())
+
+    if args.json_report:
+        with open(args.json_report, 'w', encoding='utf-8') as report:
+            json.dump({
+                'summary': profiler.summary(),
+                'messages': profiler.records,
+                'failed': [record['message_id'] for record in profiler.failed_records()]
+            }, report, indent=2)
+
+
+if __name__ == '__main__':
+    main()
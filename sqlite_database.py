@@ -0,0 +1,151 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_messages (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  message_id TEXT NOT NULL UNIQUE,
+  chat_time TEXT NOT NULL,
+  chat_name TEXT NOT NULL,
+  phone_number TEXT NOT NULL,
+  current_message TEXT NOT NULL,
+  source TEXT DEFAULT 'webhook',
+  processed INTEGER DEFAULT 0,
+  raw_data TEXT,
+  created_at TEXT DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_phone_number ON webhook_messages(phone_number);
+CREATE INDEX IF NOT EXISTS idx_chat_name ON webhook_messages(chat_name);
+
+CREATE TABLE IF NOT EXISTS message_history (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  message_id TEXT NOT NULL,
+  sender TEXT NOT NULL,
+  content TEXT NOT NULL,
+  timestamp TEXT NOT NULL,
+  message_type TEXT DEFAULT 'text',
+  created_at TEXT DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_history_message_id ON message_history(message_id);
+
+CREATE TABLE IF NOT EXISTS analytics_results (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  message_id TEXT NOT NULL,
+  urgency_score INTEGER NOT NULL DEFAULT 1,
+  category TEXT NOT NULL DEFAULT 'general',
+  sentiment TEXT NOT NULL DEFAULT 'neutral',
+  keywords TEXT,
+  priority_level TEXT NOT NULL DEFAULT 'normal',
+  action_required INTEGER DEFAULT 0,
+  processed_at TEXT DEFAULT (datetime('now', 'localtime'))
+);
+"""
+
+
+def _adapt(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+class SQLiteDatabase:
+    """Drop-in replacement for DatabaseManager backed by SQLite (use ':memory:' for an in-memory store)."""
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def execute_query(self, query: str, params: tuple = None) -> Any:
+        sql = query.replace('%s', '?')
+        params = tuple(_adapt(p) for p in (params or ()))
+
+        with self.lock:
+            try:
+                cursor = self.connection.execute(sql, params)
+
+                if query.strip().upper().startswith('SELECT'):
+                    result = [dict(row) for row in cursor.fetchall()]
+                else:
+                    self.connection.commit()
+                    result = cursor.lastrowid
+
+                return result
+            except sqlite3.Error as e:
+                logger.error(f"Query execution error: {e}")
+                return None
+
+    def save_webhook_message(self, message: Dict) -> Optional[int]:
+        query = """
+        INSERT INTO webhook_messages
+        (message_id, chat_time, chat_name, phone_number, current_message, source, processed)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+
+        params = (
+            message.get('message_id', f"msg_{datetime.now().timestamp()}"),
+            message.get('chat_time', datetime.now()),
+            message.get('chat_name', ''),
+            message.get('phone_number', ''),
+            message.get('current_message', ''),
+            message.get('source', 'webhook'),
+            False
+        )
+
+        return self.execute_query(query, params)
+
+    def save_message_history(self, message_id: str, history: List[Dict]) -> bool:
+        query = """
+        INSERT INTO message_history (message_id, sender, content, timestamp, message_type)
+        VALUES (?, ?, ?, ?, ?)
+        """
+
+        rows = [
+            (
+                message_id,
+                msg.get('sender', ''),
+                msg.get('content', ''),
+                _adapt(msg.get('timestamp', datetime.now())),
+                msg.get('type', 'text')
+            )
+            for msg in history
+        ]
+
+        with self.lock:
+            try:
+                self.connection.executemany(query, rows)
+                self.connection.commit()
+                return True
+            except sqlite3.Error as e:
+                logger.error(f"Error saving message history: {e}")
+                self.connection.rollback()
+                return False
+
+    def save_analytics_result(self, message_id: str, analysis: Dict) -> bool:
+        query = """
+        INSERT INTO analytics_results
+        (message_id, urgency_score, category, sentiment, keywords, priority_level, action_required)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+
+        params = (
+            message_id,
+            analysis.get('urgency_score', 0),
+            analysis.get('category', 'general'),
+            analysis.get('sentiment', 'neutral'),
+            json.dumps(analysis.get('keywords', [])),
+            analysis.get('priority_level', 'normal'),
+            analysis.get('action_required', False)
+        )
+
+        return self.execute_query(query, params) is not None